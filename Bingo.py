@@ -23,9 +23,7 @@ When generating multiple cards, two of them (with the default size) should fit
 on one page of DIN A4 paper when printed.  Check your browser's printing
 preview and, if necessary, adjust the CSS section of the HTML template.
 
-Requires Python_ version 2.5 or greater, and Jinja2_ (tested with 2.6, earlier
-versions may work). For a Python version before 2.7, the argparse_ module must
-be installed separately.
+Requires Python_ 3 and Jinja2_ (see ``requirements.txt``).
 
 
 Changelog
@@ -50,21 +48,122 @@ Changelog
 :License: MIT
 """
 
-from __future__ import with_statement
 import argparse
-import codecs
-from collections import namedtuple
-from itertools import chain, islice, zip_longest, repeat
-from random import randrange, sample
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import hashlib
+import os
+import random
 import sys
 
 import jinja2
+from markupsafe import escape, Markup
 
 
-Field = namedtuple('Field', ['type', 'value'])
+# Fields are rendered to their final HTML up front so the template only has
+# to output them.
+FIELD_EMPTY = Markup('-')
+FIELD_BONUS = Markup('<strong>Bingo!</strong>')
 
-FIELD_EMPTY = Field('empty', None)
-FIELD_BONUS = Field('bonus', None)
+# A single generator instance shared by all cards.
+_RNG = random.Random()
+
+# Card parameters of a worker process, set by `_init_worker`.
+_worker_fields = None
+_worker_size = None
+
+@lru_cache()
+def _get_template():
+    """Load and compile the page template on first use, so `--fast` runs work
+    without `template.html`.
+    """
+    try:
+        return _get_environment(_get_bytecode_cache()).get_template(
+            "template.html")
+    except OSError:
+        # Reading or writing the bytecode cache failed; compile without it.
+        return _get_environment(None).get_template("template.html")
+
+def _get_environment(bytecode_cache):
+    """Create the Jinja environment for the current directory's templates."""
+    # The search path is absolute so each directory gets its own cache key.
+    # Auto-reloading is disabled to skip the per-render `stat()` of the file.
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(searchpath=os.path.abspath('.')),
+        autoescape=True,
+        bytecode_cache=bytecode_cache,
+        auto_reload=False)
+
+def _get_bytecode_cache():
+    """Return a cache for compiled templates so later runs skip parsing, or
+    `None` if the cache directory cannot be created or written to.
+    """
+    cache_home = (os.environ.get('XDG_CACHE_HOME')
+        or os.path.join(os.path.expanduser('~'), '.cache'))
+    cache_dir = os.path.join(cache_home, 'bingo_jinja')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return None
+    if not os.access(cache_dir, os.W_OK):
+        return None
+    return jinja2.FileSystemBytecodeCache(cache_dir)
+
+# SHA-256 of the stock `template.html`.  A template with any other content
+# has been customised and must be rendered with Jinja.
+STOCK_TEMPLATE_SHA256 = (
+    'ee82fb6de2bfbe4a4877d330b344a3c998108aa48c0bcc40b686db949a29c144')
+
+# Built-in page layout, producing the same output as the stock
+# `template.html`.  Used by `render_html_fast`.  Keep this and
+# `STOCK_TEMPLATE_SHA256` in sync with `template.html`.
+HTML_HEADER = '''\
+<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8"/>
+    <style>
+      @media print {
+        html,
+        body {
+          margin: 0;
+        }
+      }
+
+      h1 {
+        font-size: 6mm;
+      }
+
+      table {
+        border-color: #666666;
+        border-spacing: 0;
+        border-style: solid;
+        border-width: 0 0.25mm 0.25mm 0;
+        margin-bottom: 1cm;
+      }
+      td {
+        border-color: #666666;
+        border-style: solid;
+        border-width: 0.25mm 0 0 0.25mm;
+        font-size: 4mm;
+        height: 2cm;
+        text-align: center;
+        width: 3cm;
+      }
+      td strong {
+        font-size: 120%;
+        text-transform: uppercase;
+      }
+    </style>
+    <title>iRODS Bingo</title>
+  </head>
+  <body>'''
+HTML_TABLE_START = '''<h1>iRODS Bingo</h1>
+    <table cellspacing="1">'''
+HTML_TABLE_END = '</table>'
+HTML_FOOTER = '''</body>
+</html>'''
 
 def parse_args():
     """Parse command line arguments."""
@@ -87,42 +186,116 @@ def parse_args():
 
     parser.add_argument('-s', '--card-size',
         dest='card_size',
-        type=int,
+        type=positive_int,
         default=5,
         help='number of rows and columns per card (default: 5)')
 
+    parser.add_argument('-f', '--fast',
+        dest='use_builtin_layout',
+        action='store_true',
+        default=False,
+        help='write the cards with the built-in layout instead of '
+             'template.html (faster)')
+
+    parser.add_argument('-j', '--jobs',
+        dest='jobs',
+        type=positive_int,
+        default=1,
+        help='number of worker processes used to build the cards '
+             '(default: 1)')
+
     return parser.parse_args()
 
+def positive_int(value):
+    """Convert a command line argument to an integer of at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            'must be at least 1, got {}'.format(value))
+    return number
+
 def load_words(filename):
     """Load words from a file.
 
     Every line is to be considered as one word.
     """
-    #with codecs.open(filename, 'rb') as f:
-    with codecs.open(filename, 'r') as f:
-        for line in f:
-            # Only yield non-empty, non-whitespace lines.
-            line = line.strip()
-            if line:
-                yield line
-
-def build_table(values, size, include_bonus_field=False):
+    with open(filename, 'r', encoding='utf-8') as f:
+        lines = f.read().split('\n')
+
+    # Only keep non-empty, non-whitespace lines.
+    return [line.strip() for line in lines if line and not line.isspace()]
+
+def build_table(values, size, bonus_position=None):
     """Build a 2-dimensional table of the given size with unique, random
     values.
 
+    The values are expected to be escaped already (see `escape_words`).
+
     If the table has more fields than values are available, the remaining
-    fields will be empty.
+    fields will be empty.  If `bonus_position` is given, the field at that
+    (flat) index is replaced with a bonus field.
     """
     field_total = size ** 2
-    random_values = collect_random_sublist(values, field_total)
-    fields = to_fields(random_values, field_total)
+    fields = collect_random_sublist(values, field_total)
+    fields.extend([FIELD_EMPTY] * (field_total - len(fields)))
 
-    if include_bonus_field:
-        # Replace a field at a random position with a bonus field.
-        fields[randrange(0, field_total)] = FIELD_BONUS
+    if bonus_position is not None:
+        fields[bonus_position] = FIELD_BONUS
 
     # Group into rows.
-    return zip_longest(*[iter(fields)] * size)
+    return [fields[i:i + size] for i in range(0, field_total, size)]
+
+def build_tables_parallel(fields, size, bonus_positions, jobs,
+        chunk_size=256):
+    """Build one table per bonus position in up to `jobs` worker processes
+    and yield them in order.
+
+    Each worker builds `chunk_size` tables per task.  At most two tasks per
+    worker are in flight at a time, so memory use does not grow with the
+    number of tables.  No more workers are started than there are CPUs or
+    tasks; if that leaves a single worker, the tables are built in this
+    process instead.
+    """
+    chunks = [bonus_positions[i:i + chunk_size]
+        for i in range(0, len(bonus_positions), chunk_size)]
+    workers = min(jobs, os.cpu_count() or 1, len(chunks))
+    if sys.platform == 'win32':
+        # Windows does not support more than 61 worker processes.
+        workers = min(workers, 61)
+    if workers <= 1:
+        yield from (build_table(fields, size, bonus_position)
+            for bonus_position in bonus_positions)
+        return
+
+    pending = deque()
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+            initargs=(fields, size)) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(_build_worker_tables, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def _init_worker(fields, size):
+    """Store the card parameters in a worker process and reseed its random
+    number generator, which would otherwise be a copy of the parent's.
+    """
+    global _worker_fields, _worker_size
+    _worker_fields = fields
+    _worker_size = size
+    _RNG.seed()
+
+def _build_worker_tables(bonus_positions):
+    """Build one table per bonus position from the parameters stored by
+    `_init_worker`.
+    """
+    return [build_table(_worker_fields, _worker_size, bonus_position)
+        for bonus_position in bonus_positions]
+
+def escape_words(words):
+    """Escape each word once so the result can be shared by all cards."""
+    return [escape(word) for word in words]
 
 def collect_random_sublist(values, n):
     """Return unique, random elements from the values.
@@ -132,44 +305,80 @@ def collect_random_sublist(values, n):
     """
     # The sample length must not exceed the number of available values.
     sample_length = min(n, len(values))
-    return sample(values, sample_length)
+    return _RNG.sample(values, sample_length)
 
-def to_fields(values, n):
-    """Create fields from the values, append infinite empty fields, and return
-    the first `n` items.
+def is_stock_template(filename="template.html"):
+    """Return whether the template file is missing or unchanged, i.e.
+    whether the built-in layout renders the same page as the template.
     """
-    normal_fields = (Field('normal', value) for value in values)
-    fields = chain(normal_fields, repeat(FIELD_EMPTY))
-    return take(fields, n)
-
-def take(iterable, n):
-    """Return the first `n` items of the iterable as a list."""
-    return list(islice(iterable, n))
+    try:
+        with open(filename, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return True
+    return hashlib.sha256(content).hexdigest() == STOCK_TEMPLATE_SHA256
 
 def render_html(tables):
     """Assemble an HTML page with cards from the word tables."""
-    #env = Environment(autoescape=True)
-    #template = env.from_string(TEMPLATE)
-    templateLoader = jinja2.FileSystemLoader(searchpath="./")
-    templateEnv = jinja2.Environment(loader=templateLoader, autoescape=True)
-    TEMPLATE_FILE = "template.html"
-    template = templateEnv.get_template(TEMPLATE_FILE)
-    return template.render(tables=tables)
+    return _get_template().render(tables=tables)
+
+def render_html_fast(tables, fh):
+    """Write an HTML page with cards from the word tables to the text file
+    `fh`, using the built-in layout instead of the Jinja template.
+
+    Cells are written verbatim, without Jinja's autoescaping, so they must
+    already be escaped `Markup` strings (see `escape_words`).
+    """
+    fh.write(HTML_HEADER)
+    for table in tables:
+        row_format = html_row_format(len(table))
+        fh.write(HTML_TABLE_START)
+        fh.writelines(row_format.format(*row) for row in table)
+        fh.write(HTML_TABLE_END)
+    fh.write(HTML_FOOTER)
+
+@lru_cache()
+def html_row_format(size):
+    """Return a format string for a table row with `size` cells."""
+    return '<tr>' + '<td>{}</td>' * size + '</tr>'
 
 if __name__ == '__main__':
     args = parse_args()
 
     # Load words from given file.
-    words = frozenset(load_words(args.words_file))
-
-    # Create tables of words.
-    tables = [list(build_table(words, args.card_size, args.include_bonus_field))
-        for _ in range(args.num_cards)]
-
-    # Write HTML output to stdout.  To create a file, redirect the data by
-    # appending something like ``> cards.html`` at the command line.
-    #html = render_html(tables).encode('utf-8')
-    html = render_html(tables).encode()
-    #print(html)
-    with open("Bingo.html", "wb") as fh:
-      fh.write(html)
+    words = list(dict.fromkeys(load_words(args.words_file)))
+    fields = escape_words(words)
+
+    # Pick the bonus field positions for all cards at once.
+    field_total = args.card_size ** 2
+    if args.include_bonus_field:
+        bonus_positions = _RNG.choices(range(field_total), k=args.num_cards)
+    else:
+        bonus_positions = [None] * args.num_cards
+
+    # Create tables of words lazily, so each card is built just before it is
+    # written.  Worker processes only build a bounded number of chunks ahead
+    # of the writer.
+    if args.jobs > 1:
+        tables = build_tables_parallel(fields, args.card_size, bonus_positions,
+            args.jobs)
+    else:
+        tables = (build_table(fields, args.card_size, bonus_position)
+            for bonus_position in bonus_positions)
+
+    use_builtin_layout = args.use_builtin_layout
+    if use_builtin_layout and not is_stock_template():
+        # Honour a customised template rather than silently replacing it.
+        print('template.html has been customised, ignoring --fast',
+            file=sys.stderr)
+        use_builtin_layout = False
+
+    if use_builtin_layout:
+        with open("Bingo.html", "w", encoding='utf-8', newline='') as fh:
+            render_html_fast(tables, fh)
+    else:
+        # Stream the HTML output to the file without building the whole page
+        # in memory first.
+        template = _get_template()
+        with open("Bingo.html", "wb") as fh:
+            template.stream(tables=tables).dump(fh, encoding='utf-8')